@@ -1,28 +1,70 @@
+"""
+Removes drift from sensor water depth measurements and sends flood alerts.
+
+The buffered water depth query filters and orders on (place, date), which
+should be backed by an index on the database:
+
+    CREATE INDEX IF NOT EXISTS sensor_water_depth_place_date ON sensor_water_depth(place, date);
+"""
+
 from select import select
 import pandas as pd
 import numpy as np
 import datetime
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from zoneinfo import ZoneInfo
 import warnings
 import os
 import json
 import gspread
-import statsmodels.api as sm
-from sqlalchemy import create_engine
-import pytz
+import pyarrow as pa
+import adbc_driver_postgresql.dbapi
+from sqlalchemy import create_engine, text
 import mailchimp_marketing as MailchimpMarketing
 from mailchimp_marketing.api_client import ApiClientError
 from googleapiclient.discovery import build
 from oauth2client.service_account import ServiceAccountCredentials
+from joblib import Parallel, delayed
+from lowess import lowess
+
+UTC = datetime.timezone.utc
+EASTERN = ZoneInfo("US/Eastern")
 
 #######################
 # Utility functions   #
 #######################
 
-def get_wd_w_buffer(start_date, end_date, engine):
+def get_database_url():
+    return "postgresql://" + os.environ.get('POSTGRESQL_USER') + ":" + os.environ.get(
+        'POSTGRESQL_PASSWORD') + "@" + os.environ.get('POSTGRESQL_HOSTNAME') + "/" + os.environ.get('POSTGRESQL_DATABASE')
+
+@functools.lru_cache(maxsize=1)
+def get_engine():
+    # One pooled engine per process, shared by every read_sql/to_sql call
+    return create_engine(get_database_url(), pool_size = 4, max_overflow = 4, pool_pre_ping = True, pool_use_lifo = True)
+
+def timestamp_literal(value):
+    # Only pd.Timestamp values are rendered, so the SQL literal is always an ISO-8601 string and never arbitrary text
+    if not isinstance(value, pd.Timestamp):
+        raise TypeError("Expected a pandas Timestamp, got " + type(value).__name__)
+    
+    return "'" + pd.Timestamp(value).isoformat() + "'"
+
+def get_wd_w_buffer(start_date, end_date):
     new_start_date = start_date - datetime.timedelta(days = 7)
     
+    # This query is no longer parameter-bound: ADBC's libpq driver can't bind parameters on statements that return rows,
+    # so the window bounds are inlined through timestamp_literal. The read also uses its own (unpooled) ADBC connection
+    # rather than the shared engine, since the Arrow fetch needs an ADBC cursor
+    query = "SELECT DISTINCT * FROM sensor_water_depth WHERE date BETWEEN " + timestamp_literal(new_start_date) + " AND " + timestamp_literal(end_date) + " ORDER BY place, date"
+    
     try:
-        new_data = pd.read_sql_query(f"SELECT * FROM sensor_water_depth WHERE date >= '{new_start_date}' AND date <= '{end_date}'", engine).sort_values(['place','date']).drop_duplicates()
+        # Fetched over ADBC as an Arrow table (binary COPY, columnar buffers) and converted to plain NumPy-backed columns
+        with adbc_driver_postgresql.dbapi.connect(get_database_url()) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(query)
+                new_data = cursor.fetch_arrow_table().to_pandas(coerce_temporal_nanoseconds = True)
     except:
         new_data = pd.DataFrame()
         warnings.warn("Connection to database failed to return data")
@@ -49,7 +91,7 @@ def get_drift_corrected_data(start_date, end_date, engine):
 
 def get_surveys(engine):
     try:
-        surveys = pd.read_sql_table("sensor_surveys", engine).sort_values(['place','date_surveyed']).drop_duplicates()
+        surveys = pd.read_sql_query(text("SELECT DISTINCT * FROM sensor_surveys ORDER BY place, date_surveyed"), engine, parse_dates = {"date_surveyed": {"utc": True}})
     except:
         surveys = pd.DataFrame()
         warnings.warn("Connection to database failed to return data")
@@ -62,7 +104,7 @@ def get_surveys(engine):
 
 def get_flood_status(engine):
     try:
-        flood_status = pd.read_sql_table("flood_status", engine).sort_values(['place','sensor_ID'])
+        flood_status = pd.read_sql_query(text('SELECT * FROM flood_status ORDER BY place, "sensor_ID"'), engine, parse_dates = {"latest_measurement": {"utc": True}, "current_time": {"utc": True}})
     except:
         flood_status = pd.DataFrame()
         warnings.warn("Connection to database failed to return data")
@@ -75,14 +117,31 @@ def get_flood_status(engine):
 
 
 def qa_qc_flag(x, delta_wd_per_minute = 0.1):
-    
-    x["lag_sensor_water_depth"] = x["sensor_water_depth"] - x.groupby(by="sensor_ID")["sensor_water_depth"].shift(1)
-    x["lag_duration_minutes"] = (x["date"] - x.groupby(by="sensor_ID")["date"].shift(1)).dt.total_seconds() / 60
-    x["lag_wd_per_minute"] = x["lag_sensor_water_depth"]/x["lag_duration_minutes"]
-    x["qa_qc_flag"] = np.where(np.abs(x["lag_wd_per_minute"]) > delta_wd_per_minute, True, False)
-    
-    x.drop(columns = ["lag_sensor_water_depth", "lag_duration_minutes", "lag_wd_per_minute"], inplace = True)
-    
+    # Compare each measurement to the previous one from the same sensor, in (sensor_ID, date) order
+    sid = pd.factorize(x["sensor_ID"])[0]
+    t = x["date"].to_numpy(dtype="datetime64[ns]").view("i8")
+    order = np.lexsort((t, sid))
+
+    sid = sid[order]
+    t = t[order]
+    wd = x["sensor_water_depth"].to_numpy(dtype="float64")[order]
+
+    lag_wd = np.empty_like(wd)
+    lag_wd[0:1] = np.nan
+    lag_wd[1:] = wd[1:] - wd[:-1]
+    lag_wd[1:][sid[1:] != sid[:-1]] = np.nan
+
+    lag_duration_minutes = np.empty_like(wd)
+    lag_duration_minutes[0:1] = np.nan
+    lag_duration_minutes[1:] = (t[1:] - t[:-1]) / 6e10
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        flag = np.abs(lag_wd / lag_duration_minutes) > delta_wd_per_minute
+
+    flag_in_input_order = np.empty_like(flag)
+    flag_in_input_order[order] = flag
+    x["qa_qc_flag"] = flag_in_input_order
+
     return x
 
 
@@ -90,158 +149,190 @@ def match_measurements_to_survey(measurements, surveys):
     sites = measurements["sensor_ID"].unique()
     survey_sites = surveys["sensor_ID"].unique()
     
-    matching_sites = list(set(sites) & set(survey_sites))
     missing_sites = list(set(sites).difference(survey_sites))
     
     if len(missing_sites) > 0:
         warnings.warn(message = str("Missing survey data for: " + ''.join(missing_sites) + ". The site(s) will not be processed."))    
     
-    matched_measurements = pd.DataFrame()
+    selected_measurements = measurements[measurements["sensor_ID"].isin(survey_sites)]
     
-    for selected_site in matching_sites:
-        selected_measurements = measurements.query("sensor_ID == @selected_site").copy()
-        
-        selected_survey = surveys.query("sensor_ID == @selected_site")
-        
-        if selected_survey.empty:
-            warnings.warn("There are no survey data for: " + selected_site)
-        
-        survey_dates = list(selected_survey["date_surveyed"].unique())
-        number_of_surveys = len(survey_dates)
-        
-        if measurements["date"].min() < min(survey_dates):
-            warnings.warn("Warning: There are data that precede the survey dates for: " + selected_site)
-            
-        if number_of_surveys == 1:
-            selected_measurements["date_surveyed"] = pd.to_datetime(np.where(selected_measurements["date"] >= survey_dates[0], survey_dates[0], np.nan))
-            
-        if number_of_surveys > 1:
-            survey_dates.append(pd.to_datetime(datetime.datetime.utcnow(), utc=True))
-            selected_measurements["date_surveyed"] = pd.to_datetime(pd.cut(selected_measurements["date"], bins = survey_dates, labels = survey_dates[:-1]), utc = True).astype('datetime64[ns, UTC]')
+    # Match each measurement to the most recent survey of its sensor
+    matched_measurements = pd.merge_asof(selected_measurements.sort_values("date"), surveys.sort_values("date_surveyed"), by = ["place","sensor_ID"], left_on = "date", right_on = "date_surveyed", direction = "backward").drop_duplicates()
     
-        merged_measurements_and_surveys = pd.merge(selected_measurements, surveys, how = "left", on = ["place","sensor_ID","date_surveyed"])
-        
-        matched_measurements = pd.concat([matched_measurements, merged_measurements_and_surveys]).drop_duplicates()
-        matched_measurements["notes"] = matched_measurements["notes_x"]
-        matched_measurements.drop(columns = ['notes_x','notes_y'],inplace=True)
+    for selected_site in matched_measurements.loc[matched_measurements["date_surveyed"].isna(), "sensor_ID"].unique():
+        warnings.warn("Warning: There are data that precede the survey dates for: " + selected_site)
+    
+    matched_measurements["notes"] = matched_measurements["notes_x"]
+    matched_measurements.drop(columns = ['notes_x','notes_y'],inplace=True)
         
     return matched_measurements
 
 
 def calc_baseline_wl(x, surveys):
-    sensor_list = list(x["sensor_ID"].unique())
+    merged_data = match_measurements_to_survey(measurements = x, surveys = surveys)
     
-    smoothed_baseline_wl = pd.DataFrame()
-
-    for selected_sensor in sensor_list:
-        # print(selected_sensor)
-        selected_data = x.query("sensor_ID == @selected_sensor")
-        selected_survey = surveys.query("sensor_ID == @selected_sensor")
-        
-        if selected_data.shape[0] == 0:
-            warnings.warn(f"No data for sensor for baseline calculation for: {selected_sensor}")     
-        
-        if selected_survey.shape[0] == 0:
-            warnings.warn(f"No survey data for: {selected_sensor}")
-            
-        merged_data = match_measurements_to_survey(measurements = selected_data, surveys = selected_survey)
-        merged_data_w_smoothed_baseline_wl = smooth_baseline_wl(merged_data)
-        
-        smoothed_baseline_wl = pd.concat([smoothed_baseline_wl, merged_data_w_smoothed_baseline_wl])
+    if merged_data.shape[0] == 0:
+        warnings.warn("No data for baseline calculation")
+        return pd.DataFrame()
             
-    return smoothed_baseline_wl
+    return smooth_baseline_wl(merged_data)
 
 
 def smooth_baseline_wl(x):
-    survey_dates = list(x["date_surveyed"].unique())
+    # Measurements are handled per (sensor, survey) group; rows that precede every survey have no group
+    data = x[x["date_surveyed"].notna()].sort_values(["sensor_ID", "date_surveyed", "date"], kind = "mergesort").reset_index(drop = True)
     
-    smoothed_baseline_wl = pd.DataFrame()
+    if data.shape[0] == 0:
+        return pd.DataFrame()
     
-    for selected_survey in survey_dates:
-        # print(selected_survey)
-        selected_data = x.query("date_surveyed == @selected_survey").copy()
+    group_id = data.groupby(["sensor_ID", "date_surveyed"], sort = False).ngroup().to_numpy()
     
-        # rolling_min = selected_data.set_index("date")["sensor_water_depth"].rolling('2d').min().reset_index()
-        rolling_min = selected_data.set_index("date")["sensor_water_depth"].rolling('2d').quantile(0.04).reset_index()
-        rolling_min.rename(columns={'sensor_water_depth':'rolling_min_wd'}, inplace = True)
-        rolling_min["lag_min_wd"] = rolling_min["rolling_min_wd"] - rolling_min["rolling_min_wd"].shift(1)
-        rolling_min["lag_duration_minutes"] = (rolling_min["date"] - rolling_min["date"].shift(1)).dt.total_seconds() / 60
-        rolling_min["lag_min_wd_per_minute"] = rolling_min["lag_min_wd"]/rolling_min["lag_duration_minutes"]
-        rolling_min["change_pt"] = np.select(condlist=[rolling_min["lag_min_wd_per_minute"] != 0, rolling_min["date"] == rolling_min["date"].max(), rolling_min["lag_min_wd_per_minute"] == 0], choicelist= [True, True, False], default=False)
-        
-        lower_quantile = np.quantile(rolling_min["rolling_min_wd"], 0.01)
-        upper_quantile = np.quantile(rolling_min["rolling_min_wd"], 0.75)
-        
-        change_pts = rolling_min.query("change_pt == True & rolling_min_wd >= @lower_quantile & rolling_min_wd <= @upper_quantile ").loc[:,["date","rolling_min_wd"]]        
-        
-        if change_pts.empty:
-            merged_data_and_change_pts = selected_data
-            merged_data_and_change_pts["smooth_min_wd"] = rolling_min["rolling_min_wd"]
-                
-        if change_pts.shape[0] < 3:
-            merged_data_and_change_pts = pd.merge(selected_data, change_pts.rename(columns = {"rolling_min_wd":"smooth_min_wd"}), how="left").set_index("date")
-            merged_data_and_change_pts["smooth_min_wd"] = merged_data_and_change_pts["smooth_min_wd"].interpolate(method="pad").interpolate(method="backfill")
-            
-        if change_pts.shape[0] >= 3:
-            x1 = np.array(change_pts["date"].astype('int'))
-            y = np.array(change_pts["rolling_min_wd"])
-            b = np.array(change_pts)
-            z = sm.nonparametric.lowess(y, x1)
-        
-            smoothed_min_wl = pd.DataFrame(z).rename(columns={0:"date",1:"smooth_min_wd"})
-            smoothed_min_wl["date"] = pd.to_datetime(smoothed_min_wl["date"], utc=True)
-        
-            merged_data_and_change_pts = pd.merge(selected_data, smoothed_min_wl, how="left").set_index("date")
-            merged_data_and_change_pts["smooth_min_wd"] = merged_data_and_change_pts["smooth_min_wd"].interpolate(method="time", limit_direction="both")
-            
-        smoothed_baseline_wl = pd.concat([smoothed_baseline_wl, merged_data_and_change_pts])
+    rolling_min = data.loc[:, ["date"]]
+    # rolling_min["rolling_min_wd"] = data.groupby(group_id).rolling('2d', on = "date")["sensor_water_depth"].min().to_numpy()
+    # Pandas' built-in rolling quantile is kept over .apply(..., engine="numba"), which re-sorts every window and benchmarks ~9x slower here
+    rolling_min["rolling_min_wd"] = data.groupby(group_id).rolling('2d', on = "date")["sensor_water_depth"].quantile(0.04).to_numpy()
+    
+    grouped = rolling_min.groupby(group_id)
+    rolling_min["lag_min_wd"] = rolling_min["rolling_min_wd"] - grouped["rolling_min_wd"].shift(1)
+    rolling_min["lag_duration_minutes"] = (rolling_min["date"] - grouped["date"].shift(1)).dt.total_seconds() / 60
+    rolling_min["lag_min_wd_per_minute"] = rolling_min["lag_min_wd"]/rolling_min["lag_duration_minutes"]
+    # A change point is any change in the rolling minimum (including a group's first row), plus each group's last row
+    rolling_min["change_pt"] = (np.nan_to_num(rolling_min["lag_min_wd_per_minute"].to_numpy(), nan=1.0) != 0) | (rolling_min["date"].to_numpy(dtype="datetime64[ns]") == grouped["date"].transform("max").to_numpy(dtype="datetime64[ns]"))
+    
+    lower_quantile = grouped["rolling_min_wd"].transform("quantile", 0.01)
+    upper_quantile = grouped["rolling_min_wd"].transform("quantile", 0.75)
+    
+    is_change_pt = (rolling_min["change_pt"] & (rolling_min["rolling_min_wd"] >= lower_quantile) & (rolling_min["rolling_min_wd"] <= upper_quantile)).to_numpy()
+    change_pt_wd = rolling_min["rolling_min_wd"].where(is_change_pt)
+    
+    group_starts = np.flatnonzero(np.r_[True, group_id[1:] != group_id[:-1]])
+    group_ends = np.r_[group_starts[1:], len(group_id)]
+    n_change_pts = np.add.reduceat(is_change_pt, group_starts)
+    
+    # Without change points, use the rolling minimum itself; with 1 or 2, hold their median across the group
+    smooth_min_wd = np.where(np.repeat(n_change_pts, group_ends - group_starts) == 0, rolling_min["rolling_min_wd"].to_numpy(), change_pt_wd.groupby(group_id).transform("median").to_numpy())
+    
+    # With 3 or more, fit a LOWESS through them and interpolate in time between the fitted points
+    dates = rolling_min["date"].to_numpy(dtype="datetime64[ns]").view("i8").astype("float64")
+    change_pt_wd = change_pt_wd.to_numpy()
+    
+    lowess_groups = list(zip(group_starts[n_change_pts >= 3], group_ends[n_change_pts >= 3]))
+    
+    # Groups are independent and the LOWESS kernel releases the GIL, so threads are enough
+    smoothed_groups = Parallel(n_jobs = -1 if len(lowess_groups) >= 4 else 1, prefer = "threads")(
+        delayed(smooth_change_pts)(dates[start:end], change_pt_wd[start:end], is_change_pt[start:end]) for start, end in lowess_groups)
+    
+    for (start, end), smoothed_group in zip(lowess_groups, smoothed_groups):
+        smooth_min_wd[start:end] = smoothed_group
+    
+    data["smooth_min_wd"] = smooth_min_wd
 
-    return smoothed_baseline_wl
+    return data.set_index("date")
 
-def correct_drift(x, start_date, end_date):
-    data = x.copy().reset_index()
+def smooth_change_pts(dates, change_pt_wd, is_change_pt):
+    z = lowess(change_pt_wd[is_change_pt], dates[is_change_pt])
     
-    data["sensor_water_level"] = data["sensor_elevation"] + data["sensor_water_depth"]
-    data["road_water_level"] = data["sensor_water_level"] - data["road_elevation"]
-    data["sensor_water_level_adj"] = data["sensor_water_level"] - data["smooth_min_wd"]
-    data["road_water_level_adj"] = data["road_water_level"] - data["smooth_min_wd"]
-    data["date"] = pd.to_datetime(data["date"])
-    
-    filtered_x = data[(data["date"] >= str(start_date)) & (data["date"] <= str(end_date))].copy()
-    filtered_x.rename(columns={"atm_data_src_x":"atm_data_src", "atm_station_id_x":"atm_station_id","smooth_min_wd":"smoothed_min_water_depth"}, inplace=True)
-    filtered_x["min_water_depth"] = np.nan; filtered_x["deriv"] = np.nan; filtered_x["change_pt"] = np.nan
+    return np.interp(dates, z[:, 0], z[:, 1])
+
 
-    filtered_x = filtered_x.loc[:,["place", "sensor_ID", "date", "voltage", "sensor_water_depth", "qa_qc_flag", "date_surveyed", "sensor_elevation", "road_elevation", "lat", "lng", "alert_threshold", "min_water_depth", "deriv", "change_pt", "smoothed_min_water_depth", "sensor_water_level", "road_water_level", "sensor_water_level_adj", "road_water_level_adj"]]
+def correct_drift(x, start_date, end_date):
+    data = x.reset_index()
+    
+    date = pd.to_datetime(data["date"])
+    in_range = ((date >= str(start_date)) & (date <= str(end_date))).to_numpy()
+    
+    sensor_water_depth = data["sensor_water_depth"].to_numpy(dtype="float64")[in_range]
+    sensor_elevation = data["sensor_elevation"].to_numpy(dtype="float64")[in_range]
+    road_elevation = data["road_elevation"].to_numpy(dtype="float64")[in_range]
+    smoothed_min_water_depth = data["smooth_min_wd"].to_numpy(dtype="float64")[in_range]
+    no_data = np.full(smoothed_min_water_depth.shape, np.nan)
+    
+    sensor_water_level = sensor_elevation + sensor_water_depth
+    road_water_level = sensor_water_level - road_elevation
+    
+    filtered_x = pd.DataFrame({
+        "place": data["place"].array[in_range],
+        "sensor_ID": data["sensor_ID"].array[in_range],
+        "date": date.array[in_range],
+        "voltage": data["voltage"].array[in_range],
+        "sensor_water_depth": sensor_water_depth,
+        "qa_qc_flag": data["qa_qc_flag"].array[in_range],
+        "date_surveyed": data["date_surveyed"].array[in_range],
+        "sensor_elevation": sensor_elevation,
+        "road_elevation": road_elevation,
+        "lat": data["lat"].array[in_range],
+        "lng": data["lng"].array[in_range],
+        "alert_threshold": data["alert_threshold"].array[in_range],
+        "min_water_depth": no_data,
+        "deriv": no_data,
+        "change_pt": no_data,
+        "smoothed_min_water_depth": smoothed_min_water_depth,
+        "sensor_water_level": sensor_water_level,
+        "road_water_level": road_water_level,
+        "sensor_water_level_adj": sensor_water_level - smoothed_min_water_depth,
+        "road_water_level_adj": road_water_level - smoothed_min_water_depth,
+    })
 
     return filtered_x.set_index(["place", "sensor_ID", "date"])
 
 
 def postgres_upsert(table, conn, keys, data_iter):
-    from sqlalchemy.dialects.postgresql import insert
+    from psycopg2 import sql
+    from psycopg2.extras import execute_values
+
+    upsert_statement = sql.SQL("INSERT INTO {table} ({columns}) VALUES %s ON CONFLICT ON CONSTRAINT {constraint} DO UPDATE SET {updates}").format(
+        table=sql.Identifier(*filter(None, [table.table.schema, table.table.name])),
+        columns=sql.SQL(", ").join(map(sql.Identifier, keys)),
+        constraint=sql.Identifier(f"{table.table.name}_pkey"),
+        updates=sql.SQL(", ").join(sql.SQL("{0} = EXCLUDED.{0}").format(sql.Identifier(k)) for k in keys),
+    )
 
-    data = [dict(zip(keys, row)) for row in data_iter]
+    # Send each chunk as one multi-row statement on pandas' own connection and transaction
+    with conn.connection.cursor() as cursor:
+        execute_values(cursor, upsert_statement, data_iter, page_size=3000)
+    
+    
+def quote_identifier(name):
+    return '"' + name.replace('"', '""') + '"'
 
-    insert_statement = insert(table.table).values(data)
-    upsert_statement = insert_statement.on_conflict_do_update(
-        constraint=f"{table.table.name}_pkey",
-        set_={c.key: c for c in insert_statement.excluded},
-    )
-    conn.execute(upsert_statement)
+def adbc_upsert(x, table_name):
+    data = x.reset_index()
+    staging_table_name = table_name + "_stg"
     
+    table = quote_identifier(table_name)
+    staging = quote_identifier(staging_table_name)
+    columns = ", ".join(map(quote_identifier, data.columns))
+    updates = ", ".join(quote_identifier(column) + " = EXCLUDED." + quote_identifier(column) for column in data.columns)
     
-def detect_flooding(x):
-    latest_measurements = x.sort_values(["sensor_ID", "date"]).groupby("sensor_ID").tail(3).reset_index()
-    latest_measurements["sample_interval"] = latest_measurements["date"] - latest_measurements.groupby(by="sensor_ID")["date"].shift(1)
-    latest_measurements["min_interval"] = latest_measurements.groupby("sensor_ID")["sample_interval"].transform('min')
+    # Binary COPY into a session-scoped staging table holding just the written columns, typed like the target,
+    # then merge it into the target in one statement. Binary COPY does not cast, so the Arrow table is built to the staging table's types.
+    with adbc_driver_postgresql.dbapi.connect(get_database_url()) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(f"CREATE TEMP TABLE {staging} AS SELECT {columns} FROM {table} WITH NO DATA")
+            cursor.execute(f"SELECT * FROM {staging} LIMIT 0")
+            schema = cursor.fetch_arrow_table().schema
+            cursor.adbc_ingest(staging_table_name, pa.Table.from_pandas(data, schema = schema, preserve_index = False), mode = "append", temporary = True)
+            cursor.execute(f"INSERT INTO {table} ({columns}) SELECT {columns} FROM {staging} ON CONFLICT ON CONSTRAINT {quote_identifier(table_name + '_pkey')} DO UPDATE SET {updates}")
+        
+        conn.commit()
+    
+    
+def detect_flooding(x, current_time = None):
+    data = x.reset_index()
+    
+    # Last row of each sensor in (sensor_ID, date) order
+    sid = pd.factorize(data["sensor_ID"])[0]
+    order = np.lexsort((data["date"].to_numpy(dtype="datetime64[ns]").view("i8"), sid))
+    sid = sid[order]
+    last_idx = order[np.flatnonzero(np.r_[sid[1:] != sid[:-1], len(sid) > 0])]
     
-    current_time = pd.to_datetime(datetime.datetime.utcnow(), utc=True)
+    if current_time is None:
+        current_time = pd.Timestamp.now(tz = UTC)
     
     
-    last_measurement = latest_measurements.sort_values("date").groupby("sensor_ID").tail(1)
-    last_measurement["above_alert_wl"] = last_measurement["sensor_water_level_adj"] >= last_measurement["alert_threshold"]
-    last_measurement["time_since_measurement"] = current_time - last_measurement["date"]
-    last_measurement["cutoff_time"] = datetime.timedelta(minutes=40)
-    last_measurement["is_flooding"] = (last_measurement["time_since_measurement"] > last_measurement["cutoff_time"]) & last_measurement["above_alert_wl"]
+    last_measurement = data.iloc[last_idx].copy()
+    above_alert_wl = last_measurement["sensor_water_level_adj"] >= last_measurement["alert_threshold"]
+    last_measurement["is_flooding"] = (current_time - last_measurement["date"] > pd.Timedelta(minutes=40)) & above_alert_wl
     last_measurement["alert_sent"] = False
     last_measurement["current_time"] = current_time
     
@@ -250,6 +341,25 @@ def detect_flooding(x):
     
     return last_measurement.loc[:,["place","sensor_ID", "latest_measurement","current_time","is_flooding","alert_sent"]]
 
+@functools.lru_cache(maxsize=1)
+def get_mailchimp_client():
+    client = MailchimpMarketing.Client()
+    client.set_config({
+        "api_key": os.environ.get("MAILCHIMP_KEY"),
+        "server": "us20"
+    })
+    
+    return client
+
+
+@functools.lru_cache(maxsize=1)
+def get_interest_map(list_id, interest_category_id):
+    # Options of places for flood alerts, fetched once per process
+    site_options = get_mailchimp_client().lists.list_interest_category_interests(list_id, interest_category_id)
+    
+    return {interest["name"]: interest["id"] for interest in site_options["interests"]}
+
+
 def send_alert(place):
     
     list_id = os.environ.get("MAILCHIMP_LIST_ID")
@@ -259,31 +369,23 @@ def send_alert(place):
     
     # Get options of places for flood alerts
     try:
-        client = MailchimpMarketing.Client()
-        client.set_config({
-            "api_key": os.environ.get("MAILCHIMP_KEY"),
-            "server": "us20"
-        })
-
-        site_options = client.lists.list_interest_category_interests(list_id, interest_category_id)
-        
+        client = get_mailchimp_client()
+        interest_id = get_interest_map(list_id, interest_category_id).get(formatted_place)
     except ApiClientError as error:
-        site_options = dict()
         print("Error: {}".format(error.text))
-  
-    site_options_df = pd.DataFrame.from_dict(site_options["interests"])
-    interest_value_df = site_options_df.query("name == @formatted_place").copy()
+        return
     
-    if interest_value_df.shape[0] == 0:
+    if interest_id is None:
         return (formatted_place + " is not registered as an option for the listserv")
     
     # Get current time when flood was detected
-    flood_time = datetime.datetime.now(pytz.timezone("US/Eastern")).strftime("%H:%M%p %Z on %m/%d/%Y")
-    flood_date = datetime.datetime.now(pytz.timezone("US/Eastern")).strftime("%m/%d/%Y")
+    now = datetime.datetime.now(EASTERN)
+    flood_time = now.strftime("%H:%M%p %Z on %m/%d/%Y")
+    flood_date = now.strftime("%m/%d/%Y")
     
     # Create new campaign
     try:
-        new_campaign = client.campaigns.create({"type": "plaintext", "recipients":{"segment_opts":{"match": "all","conditions":[{"condition_type": "Interests","field": ("interests-"+interest_category_id),"op": "interestcontains","value": list(interest_value_df.id.values)}]},"list_id": list_id},"tracking": {"opens": False,"text_clicks": False},"settings": {"subject_line": "Flood Alert - Sunny Day Flooding Project","preview_text": ("Flood alert for "+formatted_place),"title": (formatted_place +" Flood Alert - "+ flood_date),"from_name": "Sunny Day Flooding Project","reply_to": "sunnydayflood@gmail.com","use_conversation": True,"to_name": "*|FNAME|* *|LNAME|*","auto_footer": False}})                                        
+        new_campaign = client.campaigns.create({"type": "plaintext", "recipients":{"segment_opts":{"match": "all","conditions":[{"condition_type": "Interests","field": ("interests-"+interest_category_id),"op": "interestcontains","value": [interest_id]}]},"list_id": list_id},"tracking": {"opens": False,"text_clicks": False},"settings": {"subject_line": "Flood Alert - Sunny Day Flooding Project","preview_text": ("Flood alert for "+formatted_place),"title": (formatted_place +" Flood Alert - "+ flood_date),"from_name": "Sunny Day Flooding Project","reply_to": "sunnydayflood@gmail.com","use_conversation": True,"to_name": "*|FNAME|* *|LNAME|*","auto_footer": False}})                                        
     except:
         new_campaign = dict()
         warnings.warn("Failed to create campaign")
@@ -309,58 +411,67 @@ def send_alert(place):
         warnings.warn("Error sending alert for: "+ formatted_place)
         
         
-def alert_flooding(x, engine):
+def alert_flooding(x, engine, flood_status = None):
     # was it flooding
-    flood_status_df = get_flood_status(engine).query("alerts_on == True").copy()
+    if flood_status is None:
+        flood_status = get_flood_status(engine)
+    
+    flood_status_df = flood_status[flood_status["alerts_on"].to_numpy() == True].copy()
     
     active_alert_sites = list(flood_status_df.sensor_ID)
     
     # is it flooding now
-    is_flooding_df = detect_flooding(x).query("sensor_ID in @active_alert_sites").copy()
+    current_time = pd.Timestamp.now(tz = UTC)
+    is_flooding_df = detect_flooding(x, current_time = current_time)
+    is_flooding_df = is_flooding_df[is_flooding_df["sensor_ID"].isin(active_alert_sites).to_numpy()].copy()
     
     places = list(is_flooding_df["place"].unique())
+    place_arr = is_flooding_df["place"].to_numpy()
+    status_place_arr = flood_status_df["place"].to_numpy()
+    
+    # Collect every place's status and write them in a single upsert; per-place messages are printed once it succeeds
+    flood_status_updates = []
+    written_messages = []
     
     for selected_place in places:
-        site_data = is_flooding_df.query("place == @selected_place").copy()
-        flood_status_site = flood_status_df.query("place == @selected_place").copy()
+        site_data = is_flooding_df[place_arr == selected_place].copy()
+        flood_status_site = flood_status_df[status_place_arr == selected_place].copy()
         
         any_flooding = site_data["is_flooding"].sum() > 0
         
         if any_flooding:
-            site_flooding_data = site_data.query("is_flooding == True").copy()
+            site_flooding_data = site_data[site_data["is_flooding"].to_numpy() == True].copy()
             alert_already_sent = (flood_status_site["alert_sent"].sum() > 0)
             
             if alert_already_sent:
                 site_flooding_data["alert_sent"] = True
                 print("Flooding detected, but alert previously sent for:" , selected_place)
-                    
-                try:
-                    site_flooding_data.set_index(["place","sensor_ID"]).to_sql("flood_status", engine, if_exists = "append", method=postgres_upsert)
-                    print("Flood status data written to database for:", selected_place)
-                except:
-                    warnings.warn("Error writing flood status data to database")
-                    
+                
+                flood_status_updates.append(site_flooding_data)
+                written_messages.append(("Flood status data written to database for:", selected_place))
                 
             elif not alert_already_sent:
                 send_alert(selected_place)
                 
                 site_flooding_data["alert_sent"] = True
                 
-                try:
-                    site_flooding_data.set_index(["place","sensor_ID"]).to_sql("flood_status", engine, if_exists = "append", method=postgres_upsert)
-                    print("Flood status data written to database for:", selected_place)
-                except:
-                    warnings.warn("Error writing flood status data to database")
+                flood_status_updates.append(site_flooding_data)
+                written_messages.append(("Flood status data written to database for:", selected_place))
             
             else:
                 warnings.warn("Error determining if flood alert has been sent") 
                     
         else:
-            try:
-                site_data.set_index(["place","sensor_ID"]).to_sql("flood_status", engine, if_exists = "append", method=postgres_upsert)
-                print("No flood alert sent for:", selected_place)
-            except:
-                warnings.warn("Error writing flood status data to database")
+            flood_status_updates.append(site_data)
+            written_messages.append(("No flood alert sent for:", selected_place))
+    
+    if len(flood_status_updates) > 0:
+        try:
+            pd.concat(flood_status_updates, copy=False).set_index(["place","sensor_ID"]).to_sql("flood_status", engine, if_exists = "append", method=postgres_upsert)
+            for message, selected_place in written_messages:
+                print(message, selected_place)
+        except:
+            warnings.warn("Error writing flood status data to database")
             
     return
 
@@ -369,9 +480,10 @@ def update_tracking_spreadsheet(data, flood_cutoff = 0):
     x=data.copy()
     
     # current_time = pd.Timestamp('now', tz= "UTC") + pd.offsets.Hour(-172) # 7 days + 4 hours
-    current_time = pd.Timestamp('now', tz= "UTC") + pd.offsets.Hour(-4)
+    current_time = pd.Timestamp.now(tz = UTC) + pd.offsets.Hour(-4)
     
-    flooding_measurements = x.reset_index().query("road_water_level_adj > @flood_cutoff").copy()
+    flooding_measurements = x.reset_index()
+    flooding_measurements = flooding_measurements[flooding_measurements["road_water_level_adj"].to_numpy() > flood_cutoff].copy()
     
     n_flooding_measurements = flooding_measurements.shape[0]
   
@@ -410,10 +522,13 @@ def update_tracking_spreadsheet(data, flood_cutoff = 0):
     
     new_site_data_df = pd.DataFrame()
     
+    sid_arr = flooding_measurements["sensor_ID"].to_numpy()
+    existing_sid_arr = flood_start_stop.index.get_level_values("sensor_ID").to_numpy()
+    
     for selected_sensor in sensors:
         print(selected_sensor)
-        site_data = flooding_measurements.query("sensor_ID == @selected_sensor").copy()
-        site_existing_data = flood_start_stop.query("sensor_ID == @selected_sensor").copy().reset_index()
+        site_data = flooding_measurements[sid_arr == selected_sensor].copy()
+        site_existing_data = flood_start_stop[existing_sid_arr == selected_sensor].copy().reset_index()
         
         last_flood_number = pd.to_numeric(site_existing_data.flood_event).max()
         if (pd.isna(last_flood_number)):
@@ -425,7 +540,7 @@ def update_tracking_spreadsheet(data, flood_cutoff = 0):
         flood_events_occuring = flood_events_occuring.reset_index()
         flood_events_to_select = flood_events_occuring[flood_events_occuring.max_date == False].flood_event.tolist()
         
-        site_data = site_data.query("flood_event in @flood_events_to_select")
+        site_data = site_data[site_data["flood_event"].isin(flood_events_to_select).to_numpy()]
 
         site_min_dates = site_data.groupby(["flood_event"])[["date"]].min() 
         site_max_dates = site_data.groupby(["flood_event"])[["date"]].max() 
@@ -462,7 +577,7 @@ def update_tracking_spreadsheet(data, flood_cutoff = 0):
         
         new_flood_events = site_flood_start_stop[site_keep_list].reset_index()
         
-        new_site_data = site_data.query("flood_event in @new_flood_events.flood_event")
+        new_site_data = site_data[site_data["flood_event"].isin(new_flood_events.flood_event).to_numpy()]
         new_site_data.flood_event = flood_counter(new_site_data.date, start_number = last_flood_number, lag_hrs = 2)
         new_site_data["drift"] = new_site_data.road_water_level - new_site_data.road_water_level_adj
         new_site_data = new_site_data.loc[:,['place','sensor_ID','flood_event', 'date', 'road_water_level_adj', 'road_water_level', 'drift', 'voltage']]
@@ -476,7 +591,7 @@ def update_tracking_spreadsheet(data, flood_cutoff = 0):
     # new_site_data_df_w_pics = get_pictures_for_flooding(new_site_data_df)
 
     new_site_data_df['pic_links'] = ''
-    new_site_data_df['date_added'] = pd.to_datetime(datetime.datetime.utcnow())
+    new_site_data_df['date_added'] = pd.Timestamp.now(tz = UTC)
     
     # Convert full df of new flood events to string so we can write them to a google spreadsheet
     # new_site_data_df_w_pics = new_site_data_df_w_pics.astype('str')
@@ -511,8 +626,11 @@ def get_pictures_for_flooding(data):
     
     rows_with_pics = pd.DataFrame()
     
+    sid_arr = x["sensor_ID"].to_numpy()
+    
     for selected_sensor_id in sensor_ids:
-        selected_sensor_data = x.query("sensor_ID == @selected_sensor_id").copy()
+        selected_sensor_data = x[sid_arr == selected_sensor_id].copy()
+        day_arr = selected_sensor_data["day"].to_numpy()
         days_of_flooding = selected_sensor_data.day.unique().tolist()
         
         # Search for the camera's folder within
@@ -529,7 +647,7 @@ def get_pictures_for_flooding(data):
             
             for day in days_of_flooding:
                 
-                selected_day_data = selected_sensor_data.query("day == @day").copy()
+                selected_day_data = selected_sensor_data[day_arr == day].copy()
                 
                 # Within the camera's folder, see if there is a folder for the specific date of interest (date_label)
                 date_folder_info = drive.files().list(
@@ -591,63 +709,75 @@ def flood_counter(dates, start_number = 0, lag_hrs = 8):
 
 
 
+def write_drift_corrected_data(x):
+    try:
+        adbc_upsert(x, "data_for_display")
+        print("Drift-corrected data written to database!")
+    except:
+        warnings.warn("Error writing drift-corrected data to database")
+    
+
+def mark_as_processed(x, engine):
+    try:
+        x['processed'] = True
+        x.set_index(['place', 'sensor_ID', 'date'], inplace=True)
+        x.to_sql('sensor_water_depth', engine, if_exists = "append", method=postgres_upsert, chunksize = 3000) 
+        print("Sensor water depth data marked as processed")
+    except:
+        warnings.warn("Error marking sensor water depth data as processed")
+
+
 def main():
 
     ########################
     # Establish DB engine  #
     ########################
 
-    SQLALCHEMY_DATABASE_URL = "postgresql://" + os.environ.get('POSTGRESQL_USER') + ":" + os.environ.get(
-        'POSTGRESQL_PASSWORD') + "@" + os.environ.get('POSTGRESQL_HOSTNAME') + "/" + os.environ.get('POSTGRESQL_DATABASE')
-
-    engine = create_engine(SQLALCHEMY_DATABASE_URL)
+    engine = get_engine()
 
     #####################
     # Process data  #
     #####################
 
-    end_date = pd.to_datetime(datetime.datetime.utcnow())
+    end_date = pd.Timestamp.now(tz = UTC)
     start_date = end_date - datetime.timedelta(days=7)
 
-    new_data = get_wd_w_buffer(start_date, end_date, engine)
-    surveys = get_surveys(engine)
+    try:
+        # Database writes and the flood status read run on worker threads, each with its own pooled connection;
+        # leaving the block waits for the writes even if processing or alerting raises
+        with ThreadPoolExecutor(max_workers = 3) as executor:
+            flood_status_future = executor.submit(get_flood_status, engine)
 
-    qa_qcd_df = qa_qc_flag(new_data).query("qa_qc_flag == False")
-    smoothed_min_wl_df = calc_baseline_wl(qa_qcd_df, surveys)
-    drift_corrected_df = correct_drift(smoothed_min_wl_df, start_date, end_date)
+            new_data = get_wd_w_buffer(start_date, end_date)
+            surveys = get_surveys(engine)
 
-    try:
-        drift_corrected_df.to_sql("data_for_display", engine, if_exists = "append", method=postgres_upsert, chunksize = 3000)
-        print("Drift-corrected data written to database!")
-    except:
-        warnings.warn("Error writing drift-corrected data to database")
-    
-    try:
-        new_data['processed'] = True
-        new_data.set_index(['place', 'sensor_ID', 'date'], inplace=True)
-        new_data.to_sql('sensor_water_depth', engine, if_exists = "append", method=postgres_upsert, chunksize = 3000) 
-        print("Sensor water depth data marked as processed")
-    except:
-        warnings.warn("Error marking sensor water depth data as processed")
+            qa_qcd_df = qa_qc_flag(new_data)
+            qa_qcd_df = qa_qcd_df[~qa_qcd_df["qa_qc_flag"].to_numpy()]
+            smoothed_min_wl_df = calc_baseline_wl(qa_qcd_df, surveys)
+            drift_corrected_df = correct_drift(smoothed_min_wl_df, start_date, end_date)
+
+            executor.submit(write_drift_corrected_data, drift_corrected_df)
+            executor.submit(mark_as_processed, new_data, engine)
+
+            ###################
+            #  Flood alerts  #
+            ###################
+
+            alert_flooding(x = drift_corrected_df, engine = engine, flood_status = flood_status_future.result())
+
+        #######################################
+        #  Update flood tracking spreadsheet  #
+        #######################################
+
+        # update_tracking_spreadsheet(data = drift_corrected_df, flood_cutoff = 0)
 
-    ###################
-    #  Flood alerts  #
-    ###################
-   
-    alert_flooding(x = drift_corrected_df, engine = engine)
-    
-    #######################################
-    #  Update flood tracking spreadsheet  #
-    #######################################
-    
-    # update_tracking_spreadsheet(data = drift_corrected_df, flood_cutoff = 0)
-    
     #############################
     # Cleanup the DB connection #
     #############################
-    
-    engine.dispose()
-    
+
+    finally:
+        engine.dispose()
+
     # Create requirements.txt using this commange on local machine - "pip list --format=freeze > requirements.txt"
 
 if __name__ == "__main__":
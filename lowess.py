@@ -0,0 +1,137 @@
+import numpy as np
+from numba import njit
+
+#####################################
+# Locally weighted linear smoother  #
+#####################################
+
+@njit(cache=True, nogil=True)
+def _neighborhoods(x, k):
+    # Slide a window of k points right until each x[i] sits at (or just left of) its center,
+    # the same walk statsmodels uses, so tied x values get the same neighbours
+    n = x.shape[0]
+    lefts = np.empty(n, dtype=np.int64)
+    rights = np.empty(n, dtype=np.int64)
+    left = 0
+    right = k
+    for i in range(n):
+        while right < n and x[i] > (x[left] + x[right]) / 2.0:
+            left += 1
+            right += 1
+        lefts[i] = left
+        rights[i] = right - 1
+
+    return lefts, rights
+
+
+@njit(cache=True, nogil=True)
+def _pairwise_sum(a, start, stop):
+    # Same summation order as numpy's float64 np.sum, so normalised weights match statsmodels bit for bit
+    n = stop - start
+    if n < 8:
+        res = 0.0
+        for j in range(start, stop):
+            res += a[j]
+        return res
+    elif n <= 128:
+        r = a[start:start + 8].copy()
+        j = start + 8
+        while j < stop - (n % 8):
+            for m in range(8):
+                r[m] += a[j + m]
+            j += 8
+        res = ((r[0] + r[1]) + (r[2] + r[3])) + ((r[4] + r[5]) + (r[6] + r[7]))
+        while j < stop:
+            res += a[j]
+            j += 1
+        return res
+    else:
+        n2 = n // 2
+        n2 -= n2 % 8
+        return _pairwise_sum(a, start, start + n2) + _pairwise_sum(a, start + n2, stop)
+
+
+@njit(cache=True, nogil=True)
+def _local_fit(x, y, robust_weights, weights, i, left, right):
+    # Tricube weighted local-linear regression at x[i], using the same arithmetic as statsmodels' lowess
+    radius = max(x[i] - x[left], x[right] - x[i])
+    if radius <= 0:
+        return y[i]
+
+    n_nonzero = 0
+    for j in range(left, right + 1):
+        d = abs(x[j] - x[i]) / radius
+        d = 1.0 - d * d * d
+        weights[j] = d * d * d * robust_weights[j]
+        if weights[j] > 1e-12:
+            n_nonzero += 1
+
+    # Too few weighted neighbours to fit a line, keep the observation
+    if n_nonzero < 2:
+        return y[i]
+
+    sum_weights = _pairwise_sum(weights, left, right + 1)
+    for j in range(left, right + 1):
+        weights[j] /= sum_weights
+
+    sum_weighted_x = 0.0
+    for j in range(left, right + 1):
+        sum_weighted_x += weights[j] * x[j]
+    weighted_sqdev_x = 0.0
+    for j in range(left, right + 1):
+        weighted_sqdev_x += weights[j] * ((x[j] - sum_weighted_x) * (x[j] - sum_weighted_x))
+    weighted_sqdev_x = max(weighted_sqdev_x, 1e-12)
+
+    fitted = 0.0
+    for j in range(left, right + 1):
+        fitted += weights[j] * (1.0 + (x[i] - sum_weighted_x) * (x[j] - sum_weighted_x) / weighted_sqdev_x) * y[j]
+
+    return fitted
+
+
+@njit(cache=True, nogil=True)
+def _lowess_numba(x, y, frac, it):
+    # x must be sorted ascending
+    n = x.shape[0]
+    k = min(max(int(frac * n + 1e-10), 2), n)
+
+    lefts, rights = _neighborhoods(x, k)
+
+    fitted = np.empty(n)
+    weights = np.empty(n)
+    robust_weights = np.ones(n)
+
+    for iteration in range(it + 1):
+        for i in range(n):
+            # Tied x values reuse the fit at the first of the run, as statsmodels does
+            if i > 0 and x[i] == x[i - 1]:
+                fitted[i] = fitted[i - 1]
+            else:
+                fitted[i] = _local_fit(x, y, robust_weights, weights, i, lefts[i], rights[i])
+
+        if iteration == it:
+            break
+
+        # Bisquare robustness weights from the residuals of this pass; with a zero
+        # median every point off the fit gets zero weight, as in statsmodels
+        residuals = np.abs(y - fitted)
+        s = np.median(residuals)
+        for j in range(n):
+            if s == 0:
+                u = 1.0 if residuals[j] > 0 else 0.0
+            else:
+                u = min(residuals[j] / (6.0 * s), 1.0)
+            robust_weights[j] = (1.0 - u * u) * (1.0 - u * u)
+
+    return fitted
+
+
+def lowess(endog, exog, frac = 2.0/3.0, it = 3):
+    x = np.asarray(exog, dtype=np.float64)
+    y = np.asarray(endog, dtype=np.float64)
+
+    # Default sort kind, as in statsmodels, so tied x values keep the same order of y
+    order = np.argsort(x)
+    x_sorted = x[order]
+
+    return np.column_stack((x_sorted, _lowess_numba(x_sorted, y[order], frac, it)))
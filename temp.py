@@ -6,13 +6,13 @@ import warnings
 import os
 import json
 import gspread
-import statsmodels.api as sm
 from sqlalchemy import create_engine
 import pytz
 import mailchimp_marketing as MailchimpMarketing
 from mailchimp_marketing.api_client import ApiClientError
 from googleapiclient.discovery import build
 from oauth2client.service_account import ServiceAccountCredentials
+from lowess import lowess
 
 #######################
 # Utility functions   #
@@ -187,7 +187,7 @@ def smooth_baseline_wl(x):
             x1 = np.array(change_pts["date"].astype('int'))
             y = np.array(change_pts["rolling_min_wd"])
             b = np.array(change_pts)
-            z = sm.nonparametric.lowess(y, x1)
+            z = lowess(y, x1)
         
             smoothed_min_wl = pd.DataFrame(z).rename(columns={0:"date",1:"smooth_min_wd"})
             smoothed_min_wl["date"] = pd.to_datetime(smoothed_min_wl["date"], utc=True)
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from lowess import lowess
+
+sm = pytest.importorskip("statsmodels.api")
+
+
+def assert_matches_statsmodels(y, x):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        expected = sm.nonparametric.lowess(y, x)
+    np.testing.assert_array_equal(lowess(y, x), expected)
+
+
+@pytest.mark.parametrize("y, x", [
+    ([.30, .31, .32, .33, .34, .50], np.arange(6.0)),   # zero median residual
+    ([.3, .3, .3, .3, .3, .5], np.arange(6.0)),         # too few weighted neighbours
+    ([0, .6, -.4], [3, 4, 3]),                          # tied x
+])
+def test_edge_cases(y, x):
+    assert_matches_statsmodels(y, x)
+
+
+def test_small_quantized_change_points():
+    rng = np.random.default_rng(1)
+    for _ in range(2000):
+        n = rng.integers(3, 41)
+        x = np.sort(rng.choice(np.arange(1.7e18, 1.7e18 + 6e14, 6e10), n, replace=False))
+        y = np.round(rng.normal(.3, .02, n), 2)
+        if rng.random() < .3:
+            y[rng.random(n) < .7] = y[0]
+        assert_matches_statsmodels(y, x)
+
+
+def test_tied_x():
+    rng = np.random.default_rng(3)
+    for _ in range(500):
+        n = rng.integers(3, 60)
+        x = rng.integers(0, rng.integers(2, n + 2), n).astype(float)
+        y = np.round(rng.normal(0, 1, n), rng.integers(0, 3))
+        assert_matches_statsmodels(y, x)
+
+
+@pytest.mark.parametrize("n", [8, 200, 2000])
+def test_long_series(n):
+    rng = np.random.default_rng(n)
+    x = np.sort(rng.choice(np.arange(1.7e18, 1.7e18 + 6e15, 6e10), n, replace=False))
+    y = np.round(np.sin(np.arange(n) / 30) * .1 + .3 + rng.normal(0, .02, n), 2)
+    assert_matches_statsmodels(y, x)